@@ -1,11 +1,16 @@
 from pathlib import Path
+import functools
+import copy
+import itertools
+import fcntl
 import json
-import tomllib
-import psutil
 import os
 import tempfile
 from contextlib import contextmanager
+from dataclasses import dataclass
 from typing import Generator, IO
+import typer
+from qeman import ps
 
 DEFAULT_DATA_DIR = Path(os.getenv("QEMAN_HOME", Path.home() / ".qeman"))
 IMAGES_DIR = DEFAULT_DATA_DIR / "imgs"
@@ -32,6 +37,9 @@ qemu_system = "qemu-system-x86_64"
 
 METADATA_SUFFIX = ".meta.json"
 MONITOR_SUFFIX = ".monitor"
+# write_atomic's temp file names, ".<random>.tmp"
+TMP_PREFIX = "."
+TMP_SUFFIX = ".tmp"
 SSH_BASE_PORT = 4242
 
 DEFAULT_BINARIES = {
@@ -43,17 +51,54 @@ DEFAULT_SSH_CONFIG = {
     "key_path": "~/.ssh/qemu"
 }
 
+def dump_json(data) -> bytes:
+    # serialize in one go and hand the file a single buffer,
+    # json.dump would issue a write() per encoder chunk
+    return json.dumps(data, indent=2).encode()
+
+@functools.cache
 def get_config():
-    if CONFIG_PATH.exists():
-        with open(CONFIG_PATH, "rb") as f:
-            return tomllib.load(f)
-    return {}
+    # imported here: the parser costs milliseconds to import and
+    # most commands never read the config
+    import tomllib
+    try:
+        # one read of the whole (tiny) file, then parse the buffer
+        return tomllib.loads(CONFIG_PATH.read_text(encoding="utf-8"))
+    except FileNotFoundError:
+        return {}
 
-def get_ssh_config() -> Path:
+@functools.cache
+def get_ssh_config() -> dict:
     return get_config().get("ssh", DEFAULT_SSH_CONFIG)
 
+def get_qemu_config() -> dict:
+    return get_config().get("qemu", {})
+
+def scan_images() -> tuple[list[str], set[str]]:
+    """Return sorted image names and the set of those with a metadata sidecar, from one directory scan."""
+    images = []
+    with_meta = set()
+    # scandir hands back cached d_type, so only symlinks cost a stat();
+    # images kept on another disk are often linked into IMAGES_DIR
+    with os.scandir(IMAGES_DIR) as it:
+        for e in it:
+            name = e.name
+            # cheap suffix checks first, is_file() only for what is left
+            if name.endswith(METADATA_SUFFIX):
+                with_meta.add(name[:-len(METADATA_SUFFIX)])
+            elif name.startswith(TMP_PREFIX) and name.endswith(TMP_SUFFIX):
+                # a sidecar mid-write_atomic, not an image
+                continue
+            elif e.is_file():
+                images.append(name)
+    images.sort()
+    return images, with_meta
+
+def get_image_names() -> list[str]:
+    return scan_images()[0]
+
 def get_images() -> list[Path]:
-    return [f for f in IMAGES_DIR.glob("*") if not f.name.endswith(METADATA_SUFFIX)]
+    return [IMAGES_DIR / name for name in get_image_names()]
 
 def get_monitor(image: str) -> Path:
     monitor_path = MONITOR_DIR / f"{image}_monitor.sock"
@@ -62,118 +107,207 @@ def get_monitor(image: str) -> Path:
 def get_log_path(image: str) -> Path:
     return LOG_DIR / f"{image}.log"
 
-def get_running_vms() -> dict:
-    if not RUNNING_FILE.exists():
+class RunningRegistry:
+    """In-memory view of RUNNING_FILE, loaded once and flushed once."""
+
+    def __init__(self, data: dict):
+        self.data = data
+        self.dirty = False
+
+    def get(self, name: str) -> dict | None:
+        return self.data.get(name)
+
+    def set(self, name: str, info: dict):
+        self.data[name] = info
+        self.dirty = True
+
+    def delete(self, name: str):
+        if self.data.pop(name, None) is not None:
+            self.dirty = True
+
+# last parsed RUNNING_FILE and the stat key it was parsed from:
+# the stale-VM cleanup and the command itself both read the registry,
+# only the first one needs to parse it
+_running_cache: tuple[tuple[int, int, int], dict] | None = None
+
+def _stat_key(st: os.stat_result) -> tuple[int, int, int]:
+    # every write replaces the file, so the inode changes even
+    # when two writes land within the same mtime tick
+    return st.st_ino, st.st_mtime_ns, st.st_size
+
+def _read_running() -> dict:
+    global _running_cache
+    try:
+        with open(RUNNING_FILE, "rb") as f:
+            key = _stat_key(os.fstat(f.fileno()))
+            if _running_cache and _running_cache[0] == key:
+                return _running_cache[1]
+            data = json.loads(f.read())
+    except FileNotFoundError:
         return {}
-    data = json.load(open(RUNNING_FILE))
+    _running_cache = (key, data)
     return data
 
+# os.umask can only be read by setting it, so do that once up front
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+def write_atomic(path: Path, payload: bytes) -> os.stat_result:
+    """Replace `path` with `payload` in one buffered write, return the new file's stat."""
+    # sidecars land next to the images, so tag the temp file for scan_images to skip
+    tmp_fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=TMP_PREFIX, suffix=TMP_SUFFIX)
+    try:
+        with os.fdopen(tmp_fd, "wb") as f:
+            # mkstemp creates 0600, give the file the mode a plain open() would have
+            os.fchmod(f.fileno(), 0o666 & ~_UMASK)
+            f.write(payload)
+            f.flush()
+            st = os.fstat(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return st
+
+def _write_running(data: dict):
+    global _running_cache
+    st = write_atomic(RUNNING_FILE, dump_json(data))
+    _running_cache = (_stat_key(st), data)
+
+@contextmanager
+def running_registry() -> Generator[RunningRegistry, None, None]:
+    global _running_cache
+    # callers mutate nested entries in place, so hand out a deep copy;
+    # the cache only ever holds what is on disk
+    registry = RunningRegistry(copy.deepcopy(_read_running()))
+    yield registry
+    if registry.dirty:
+        try:
+            _write_running(registry.data)
+        except BaseException:
+            # running.json may or may not have been replaced, reread it next time
+            _running_cache = None
+            raise
+
+def get_running_vms() -> dict:
+    with running_registry() as registry:
+        return registry.data
+
+@functools.cache
+def get_binaries() -> dict[str, str]:
+    return {**DEFAULT_BINARIES, **get_config().get("binaries", {})}
+
 def get_binary(name: str) -> str:
-    config = get_config()
-    return config.get("binaries", {}).get(name, DEFAULT_BINARIES[name])
+    return get_binaries()[name]
 
-def get_next_ssh_port() -> int:
-    running = get_running_vms()
+def get_next_ssh_port(registry: RunningRegistry | None = None) -> int:
+    running = registry.data if registry else get_running_vms()
     used = {info["ssh_port"] for info in running.values()}
-    port = SSH_BASE_PORT
-    while port in used:
-        port += 1
-    return port
+    return next(port for port in itertools.count(SSH_BASE_PORT) if port not in used)
+
+def get_metadata_path(image_path: Path) -> Path:
+    return Path(f"{image_path}{METADATA_SUFFIX}")
 
 def get_metadata(image_path: Path):
-    meta_path = image_path.with_suffix(image_path.suffix + METADATA_SUFFIX)
-    if meta_path.exists():
-        with open(meta_path) as f:
-            return json.load(f)
-    return {}
+    try:
+        return json.loads(get_metadata_path(image_path).read_bytes())
+    except FileNotFoundError:
+        return {}
 
 def get_image(image_name: str) -> Path:
     return IMAGES_DIR / image_name
 
+def get_lock_path(image: str) -> Path:
+    return LOCKS_DIR / f"{image}.lock"
+
+@dataclass(slots=True, frozen=True)
+class ImagePaths:
+    image: Path
+    meta: Path
+    lock: Path
+    monitor: Path
+    log: Path
+
+def get_image_paths(image: str) -> ImagePaths:
+    image_path = get_image(image)
+    return ImagePaths(
+        image=image_path,
+        meta=get_metadata_path(image_path),
+        lock=get_lock_path(image),
+        monitor=get_monitor(image),
+        log=get_log_path(image),
+    )
+
 @contextmanager
 def lock_image(image: str) -> Generator[None, None, None]:
-    lock_path = LOCKS_DIR / f"{image}.lock"
-    if lock_path.exists():
-        raise FileExistsError
-    lock_path.touch()
+    # advisory lock: concurrent qeman invocations queue up behind it
+    # instead of failing, and the kernel drops it if we die,
+    # so a leftover lockfile never blocks anyone
+    fd = os.open(get_lock_path(image), os.O_CREAT | os.O_RDWR, 0o644)
     try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            # say why we are stuck instead of hanging silently
+            typer.echo(f"Waiting for lock on {image}...", err=True)
+            fcntl.flock(fd, fcntl.LOCK_EX)
         yield
     finally:
-        if lock_path.exists():
-            lock_path.unlink()
+        # closing the fd releases the lock
+        os.close(fd)
 
 def is_locked(image: str):
-    return (LOCKS_DIR / f"{image}.lock").exists()
+    try:
+        fd = os.open(get_lock_path(image), os.O_RDONLY)
+    except FileNotFoundError:
+        return False
+    try:
+        fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return True
+    finally:
+        os.close(fd)
+    return False
 
 def set_metadata(image_path: Path, metadata: dict):
-    meta_path = image_path.with_suffix(image_path.suffix + METADATA_SUFFIX)
-    with open(meta_path, "w") as f:
-        json.dump(metadata, f, indent=2)
+    meta_path = get_metadata_path(image_path)
+    # readers would choke on a half-written sidecar
+    write_atomic(meta_path, dump_json(metadata))
 
-def set_running_vm(image_name: str, pid: int, ssh_port: int):
-    RUNNING_FILE.parent.mkdir(parents=True, exist_ok=True)
-    data = json.load(open(RUNNING_FILE)) if RUNNING_FILE.exists() else {}
-    data[image_name] = {"pid": pid, "ssh_port": ssh_port}
-    json.dump(data, open(RUNNING_FILE, "w"), indent=2)
+def set_running_vm(image_name: str, pid: int, ssh_port: int, registry: RunningRegistry | None = None):
+    if registry is None:
+        with running_registry() as registry:
+            return set_running_vm(image_name, pid, ssh_port, registry)
+    registry.set(image_name, {"pid": pid, "ssh_port": ssh_port})
 
 def add_usb_device(image_name: str, device_id: str):
-    try:
-        with open(RUNNING_FILE) as f:
-            data = json.load(f)
-    except FileNotFoundError:
-        data = {}
-    vm = data.setdefault(image_name, {})
-    usb = vm.setdefault("usb_devices", [])
-    if device_id not in usb:
-        usb.append(device_id)
-
-    # atomic write
-    tmp_fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(RUNNING_FILE))
-    with os.fdopen(tmp_fd, "w") as f:
-        json.dump(data, f, indent=2)
-    os.replace(tmp_path, RUNNING_FILE)
+    with running_registry() as registry:
+        vm = registry.get(image_name) or {}
+        usb = vm.setdefault("usb_devices", [])
+        if device_id not in usb:
+            usb.append(device_id)
+            registry.set(image_name, vm)
 
 def rm_usb_device(image_name: str, device_id: str):
-    try:
-        with open(RUNNING_FILE) as f:
-            data = json.load(f)
-    except FileNotFoundError:
-        data = {}
-    vm = data.setdefault(image_name, {})
-    usb = vm.setdefault("usb_devices", [])
-    if device_id in usb:
-        usb.remove(device_id)
-
-    # atomic write
-    tmp_fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(RUNNING_FILE))
-    with os.fdopen(tmp_fd, "w") as f:
-        json.dump(data, f, indent=2)
-    os.replace(tmp_path, RUNNING_FILE)
+    with running_registry() as registry:
+        vm = registry.get(image_name) or {}
+        usb = vm.setdefault("usb_devices", [])
+        if device_id in usb:
+            usb.remove(device_id)
+            registry.set(image_name, vm)
 
 def list_usb_devices(image_name: str):
-    with open(RUNNING_FILE) as f:
-        data = json.load(f).get(image_name)
-    return data.get("usb_devices", [])
-
-def clean_stale_vms():
-    if not RUNNING_FILE.exists():
-        return
-    data = json.load(open(RUNNING_FILE))
-    changed = False
-
-    for name in list(data.keys()):
-        pid = data[name]["pid"]
-        try:
-            psutil.Process(pid)
-        except psutil.NoSuchProcess:
-            lock_path = LOCKS_DIR / name
-            if lock_path.exists():
-                lock_path.unlink()
-            monitor_path = MONITOR_DIR / f"{name}_monitor.sock"
-            if monitor_path.exists():
-                monitor_path.unlink()
-            del data[name]
-            changed = True
-
-    if changed:
-        json.dump(data, open(RUNNING_FILE, "w"), indent=2)
+    with running_registry() as registry:
+        vm = registry.get(image_name) or {}
+    return vm.get("usb_devices", [])
+
+def clean_stale_vms(registry: RunningRegistry | None = None):
+    if registry is None:
+        with running_registry() as registry:
+            return clean_stale_vms(registry)
+
+    live = ps.alive_pids([info["pid"] for info in registry.data.values()])
+    for name in list(registry.data.keys()):
+        if registry.data[name]["pid"] not in live:
+            get_image_paths(name).monitor.unlink(missing_ok=True)
+            registry.delete(name)
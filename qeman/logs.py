@@ -3,35 +3,47 @@ from contextlib import contextmanager
 from datetime import datetime
 from typing import IO, Literal
 import json
+import time
 from pathlib import Path
 from typing import Generator
 
 StreamStr = Literal["stdout", "stderr"]
 
+# (epoch second, formatted timestamp) of the last record written
+_last_ts: tuple[int, str] = (0, "")
+
+def _timestamp() -> str:
+    # logs have second resolution, so only format once per second
+    global _last_ts
+    now = int(time.time())
+    if now != _last_ts[0]:
+        _last_ts = (now, datetime.fromtimestamp(now).isoformat(timespec="seconds"))
+    return _last_ts[1]
+
 @contextmanager
-def log_file(image: str) -> Generator[IO[str], None, None]:
+def log_file(image: str) -> Generator[IO[bytes], None, None]:
     path: Path = dotfiles.get_log_path(image)
-    f: IO[str] = open(path, "a", encoding="utf-8")
-    try:
+    # binary mode: records are encoded once, no TextIOWrapper pass;
+    # the BufferedWriter batches the write()s on its own
+    with open(path, "ab") as f:
         yield f
-    finally:
-        f.close()
 
 def write_event(image: str, event: str, fields):
     payload = {
-        "ts": datetime.now().isoformat(timespec="seconds"),
+        "ts": _timestamp(),
         "event": event,
         **fields
     }
     with log_file(image) as f:
-        f.write(json.dumps(payload) + "\n")
-        f.flush()
+        f.write(json.dumps(payload).encode() + b"\n")
 
-def write_stream(f: IO[str], stream: StreamStr, data: bytes):
-    payload = {
-        "ts": datetime.now().isoformat(timespec="seconds"),
-        "to": stream,
-        "data": data.decode(errors="replace").rstrip()
-    }
-    f.write(json.dumps(payload) + "\n")
-    f.flush()
\ No newline at end of file
+def write_streams(f: IO[bytes], stream: StreamStr, lines: list[bytes]):
+    """Log the captured output lines of `stream` under a single timestamp."""
+    ts = _timestamp()
+    for line in lines:
+        payload = {
+            "ts": ts,
+            "to": stream,
+            "data": line.decode(errors="replace").rstrip()
+        }
+        f.write(json.dumps(payload).encode() + b"\n")
@@ -7,13 +7,15 @@ import subprocess
 from pathlib import Path
 from typing import Optional, List
 import os
+import sys
+import functools
+import bisect
+import select
+import selectors
 import json
+import re
 import time
-import itertools
-import threading
-import platform
-import uuid
-from typing import IO, Literal
+from typing import Literal
 from qeman import dotfiles
 from qeman import logs
 from qeman import ps
@@ -28,8 +30,33 @@ app.add_typer(list_app, name="list")
 app.add_typer(usb_app, name="usb")
 
 
-DEVNULL = open(os.devnull, "wb")
-IS_GOOD_OS = not platform.system() == "Darwin"
+IS_GOOD_OS = sys.platform != "darwin"
+# subcommands that read running.json, `usb` is a group;
+# `list vms` sweeps on its own so `list images` stays off the registry
+RUNNING_SET_COMMANDS = frozenset({"connect", "run", "kill", "rm", "code", "usb", "sync"})
+
+_URL_RE = re.compile(rb"https?://\S+")
+# a whole whitespace-delimited XXXX-XXXX token with at least one
+# uppercase letter, like the old split() + isupper() check
+_DEVICE_CODE_RE = re.compile(rb"(?<!\S)(?=[0-9-]*[A-Z])[A-Z0-9]{4}-[A-Z0-9]{4}(?!\S)")
+_ALLOWED_TUNNEL_HOSTS = frozenset({"github.com", "vscode.dev"})
+
+def _is_allowed(url: str) -> bool:
+    try:
+        u = urllib.parse.urlparse(url)
+        return u.scheme == "https" and u.hostname in _ALLOWED_TUNNEL_HOSTS
+    except ValueError:
+        return False
+
+# shared by every command that validates an image before touching it
+StrictOption = Annotated[bool, typer.Option("--strict", help="Inspect the image with qemu-img instead of only checking the qcow2 header")]
+
+@app.callback()
+def callback(ctx: Context):
+    # dropping dead VMs from the registry costs a read of running.json
+    # and a probe per VM, only pay it where the running set is used
+    if ctx.invoked_subcommand in RUNNING_SET_COMMANDS:
+        dotfiles.clean_stale_vms()
 
 def open_browser(url: str):
     datadir = Path("~/.qeman/chrome").expanduser()
@@ -41,14 +68,22 @@ def open_browser(url: str):
                     stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
 
 def complete_image_names(ctx: typer.Context, args: List[str], incomplete: str):
-    for img in sorted(dotfiles.get_images()):
-        if incomplete in img.name:
-            yield img.name
+    # names come back sorted, so the prefix matches are one contiguous run;
+    # they go first as they are what the user most likely means
+    names = dotfiles.get_image_names()
+    lo = bisect.bisect_left(names, incomplete)
+    hi = lo
+    while hi < len(names) and names[hi].startswith(incomplete):
+        hi += 1
+    yield from names[lo:hi]
+    if incomplete:
+        yield from (name for name in names[:lo] + names[hi:] if incomplete in name)
 
 def running_vm_names(ctx: Context, args: List[str], incomplete: str):
     already_entered = set(args)
-    for vm in dotfiles.get_running_vms().keys():
-        if vm.startswith(incomplete) and vm not in already_entered:
+    for vm, info in dotfiles.get_running_vms().items():
+        # completion runs without the stale-VM cleanup, skip dead ones here
+        if vm.startswith(incomplete) and vm not in already_entered and ps.is_alive(info["pid"]):
             yield vm
 
 def complete_usb_device_ids(ctx: typer.Context, incomplete: str):
@@ -60,29 +95,52 @@ def complete_usb_device_ids(ctx: typer.Context, incomplete: str):
         if dev.startswith(incomplete):
             yield dev
 
-def run_command(cmd: List[str], log: Optional[IO[str]] = None) -> int:
-    proc = subprocess.Popen(
-        cmd,
-        stdout=subprocess.PIPE if log else None,
-        stderr=subprocess.PIPE if log else None,
-        start_new_session=True
-    )
+# the child leaves our session, so it has no business reading the terminal
+_DETACHED_FILE_ACTIONS = ((os.POSIX_SPAWN_OPEN, 0, os.devnull, os.O_RDONLY, 0),)
 
-    if log is None:
-        return proc.pid
+def run_command(cmd: List[str]) -> int:
+    """Spawn `cmd` in its own session, return its pid."""
+    # nothing to pipe, so skip Popen's fork+exec machinery and let
+    # posix_spawn start it in its own session; stdout and stderr are
+    # inherited so startup errors still reach the terminal
+    return os.posix_spawnp(cmd[0], cmd, os.environ, file_actions=_DETACHED_FILE_ACTIONS, setsid=True)
 
-    def stream(pipe: IO[bytes], stream_name: Literal["stdout", "stderr"]):
-        for line in pipe:
-            logs.write_stream(log_path, stream_name, line)
+def run_and_wait(cmd: List[str], log: Optional[str] = None) -> int:
+    """Run `cmd` to completion, return its exit code.
 
-    threading.Thread(target=stream, args=(proc.stdout, "stdout"), daemon=True).start()
-    threading.Thread(target=stream, args=(proc.stderr, "stderr"), daemon=True).start()
-
-    return proc.pid
+    If `log` names an image, the process output goes to that image's log instead of the terminal.
+    """
+    result = subprocess.run(cmd, capture_output=log is not None, check=False)
+    if log:
+        with logs.log_file(log) as f:
+            logs.write_streams(f, "stdout", result.stdout.splitlines())
+            logs.write_streams(f, "stderr", result.stderr.splitlines())
+    if result.returncode != 0:
+        typer.echo(f"{Path(cmd[0]).name} exited with code {result.returncode}", err=True)
+    return result.returncode
+
+QCOW2_MAGIC = b"QFI\xfb"
+
+@functools.cache
+def _qcow2_ok(path: str, mtime_ns: int, strict: bool) -> bool:
+    # keyed on mtime_ns, so an image rewritten since its last check is looked at again
+    if strict:
+        result = subprocess.run([dotfiles.get_binary("qemu_img"), "info", "--output=json", path], capture_output=True, text=True)
+        return result.returncode == 0 and 'qcow2' in result.stdout
+    # every qcow2 image starts with this magic,
+    # reading 4 bytes beats spawning qemu-img just to look at it
+    try:
+        with open(path, "rb") as f:
+            return f.read(4) == QCOW2_MAGIC
+    except OSError:
+        return False
 
-def validate_qcow2_format(image_path: Path):
-    result = subprocess.run([dotfiles.get_binary("qemu_img"), "info", "--output=json", str(image_path)], capture_output=True, text=True)
-    if result.returncode != 0 or 'qcow2' not in result.stdout:
+def validate_qcow2_format(image_path: Path, strict: bool = False):
+    try:
+        valid = _qcow2_ok(str(image_path), os.stat(image_path).st_mtime_ns, strict)
+    except OSError:
+        valid = False
+    if not valid:
         typer.echo(f"Invalid image format or failed to inspect: {image_path.name}", err=True)
         raise typer.Exit(code=1)
 
@@ -105,70 +163,98 @@ def fork(
     cmd = [dotfiles.get_binary("qemu_img"), "create", "-f", "qcow2", "-F", "qcow2", "-b", str(base_path), str(new_path)]
 
     logs.write_event(new_image, "fork", {"dependent_of": "base_image"})
-    run_command(cmd, logs.log_file(new_image))
+    returncode = run_and_wait(cmd, new_image)
+    if returncode != 0:
+        raise typer.Exit(code=returncode)
 
 @snap_app.command("list")
-def snap_list(image: Annotated[str, Argument(help="Image to inspect", autocompletion=complete_image_names)]):
+def snap_list(
+    image: Annotated[str, Argument(help="Image to inspect", autocompletion=complete_image_names)],
+    strict: StrictOption = False,
+):
     """List all snapshots for a QCOW2 image."""
     image_path = dotfiles.get_image(image)
-    validate_qcow2_format(image_path)
-    try:
-        lock_path = dotfiles.lock_image(image_path)
-        run_command([dotfiles.get_binary("qemu_img"), "snapshot", "-l", str(image_path)])
-    except FileExistsError:
-        typer.echo(f"Image {image_path.name} appears to be in use.", err=True)
-        raise typer.Exit(code=1)
-
-    dotfiles.unlock_image(lock_path)
+    validate_qcow2_format(image_path, strict)
+    with dotfiles.lock_image(image):
+        returncode = run_and_wait([dotfiles.get_binary("qemu_img"), "snapshot", "-l", str(image_path)])
+    if returncode != 0:
+        raise typer.Exit(code=returncode)
 
 @snap_app.command("create")
 def snap_create(
     image: Annotated[str, Argument(help="Image to snapshot", autocompletion=complete_image_names)],
     name: Annotated[str, Argument(help="Name for the snapshot")],
+    strict: StrictOption = False,
 ):
     """Create a named snapshot of a QCOW2 image."""
     image_path = dotfiles.get_image(image)
-    validate_qcow2_format(image_path)
-    try:
-        lock_path = dotfiles.lock_image(image_path)
-        run_command([dotfiles.get_binary("qemu_img"), "snapshot", "-c", name, str(image_path)])
-    except FileExistsError:
-        typer.echo(f"Image {image_path.name} appears to be in use.", err=True)
-        raise typer.Exit(code=1)
-    dotfiles.unlock_image(lock_path)
+    validate_qcow2_format(image_path, strict)
+    with dotfiles.lock_image(image):
+        returncode = run_and_wait([dotfiles.get_binary("qemu_img"), "snapshot", "-c", name, str(image_path)])
+    if returncode != 0:
+        raise typer.Exit(code=returncode)
 
 @snap_app.command("apply")
 def snap_apply(
     image: Annotated[str, Argument(help="Image to restore", autocompletion=complete_image_names)],
     name: Annotated[str, Argument(help="Snapshot name to apply")],
+    strict: StrictOption = False,
 ):
     """Restore a QCOW2 image to a named snapshot."""
     image_path = dotfiles.get_image(image)
-    validate_qcow2_format(image_path)
-    try:
-        lock_path = dotfiles.lock_image(image_path)
-        run_command([dotfiles.get_binary("qemu_img"), "snapshot", "-a", name, str(image_path)])
-    except FileExistsError:
-        typer.echo(f"Image {image_path.name} appears to be in use.", err=True)
-        raise typer.Exit(code=1)
-    dotfiles.unlock_image(lock_path)
+    validate_qcow2_format(image_path, strict)
+    with dotfiles.lock_image(image):
+        returncode = run_and_wait([dotfiles.get_binary("qemu_img"), "snapshot", "-a", name, str(image_path)])
+    if returncode != 0:
+        raise typer.Exit(code=returncode)
 
 @snap_app.command("delete")
 def snap_delete(
     image: Annotated[str, Argument(help="Image containing snapshot", autocompletion=complete_image_names)],
     name: Annotated[str, Argument(help="Snapshot name to delete")],
+    strict: StrictOption = False,
 ):
     """Delete a snapshot from a QCOW2 image."""
     image_path = dotfiles.get_image(image)
-    validate_qcow2_format(image_path)
-    try:
-        lock_path = dotfiles.lock_image(image_path)
-        run_command([dotfiles.get_binary("qemu_img"), "snapshot", "-d", name, str(image_path)])
-    except FileExistsError:
-        typer.echo(f"Image {image_path.name} appears to be in use.", err=True)
-        raise typer.Exit(code=1)
+    validate_qcow2_format(image_path, strict)
+    with dotfiles.lock_image(image):
+        returncode = run_and_wait([dotfiles.get_binary("qemu_img"), "snapshot", "-d", name, str(image_path)])
+    if returncode != 0:
+        raise typer.Exit(code=returncode)
+
+@functools.cache
+def qemu_system_base(mode: Literal["run", "new"]) -> tuple[str, ...]:
+    """Part of the qemu-system command line that is the same for every image in `mode`."""
+    if mode == "new":
+        base = (
+            dotfiles.get_binary("qemu_system"),
+            "-m", "8G", "-smp", "2",
+            "-boot", "d",
+            "-netdev", "user,id=net0", "-device", "virtio-net-pci,netdev=net0",
+        )
+        if IS_GOOD_OS:
+            return base + ("--enable-kvm", "-cpu", "host", "--display", "gtk")
+        return base + ("--display", "cocoa")
 
-    dotfiles.unlock_image(lock_path)
+    base = (
+        dotfiles.get_binary("qemu_system"), "-m", "24G", "-smp", "4",
+        "-boot", "c",
+        "-device", "virtio-serial", "-device", "virtio-balloon",
+        "-device", "qemu-xhci,id=xhci", # add usb support
+        "-boot", "order=c",
+    )
+    if IS_GOOD_OS:
+        base += ("--enable-kvm", "-cpu", "host")
+    return base
+
+def qcow2_drive(image_path: Path) -> str:
+    drive = f"file={image_path},format=qcow2,if=virtio"
+    # opt-in only: a QEMU built without the backend refuses to start,
+    # and a detached launch would not notice
+    aio = dotfiles.get_qemu_config().get("aio")
+    if aio:
+        drive += f",aio={aio}"
+    return drive
 
 @app.command()
 def new(
@@ -178,50 +264,32 @@ def new(
     """Create a new VM image and boot from an installer ISO."""
     if not iso.exists():
         raise typer.BadParameter(f"Installer ISO not found: {iso}")
-    image_path = dotfiles.get_image(image_name)
+    paths = dotfiles.get_image_paths(image_name)
+    image_path = paths.image
     if not image_path.exists():
         typer.echo(f"Creating image: {image_path}")
         subprocess.run([dotfiles.get_binary("qemu_img"), "create", "-f", "qcow2", str(image_path), "100G"], check=True)
     metadata = {"created_from_iso": str(iso), "notes": ""}
     dotfiles.set_metadata(image_path, metadata)
-    monitor_path = dotfiles.get_monitor(image_path)
+    monitor_path = paths.monitor
 
     cmd = [
-        dotfiles.get_binary("qemu_system"),
-        "-m", "8G", "-smp", "2",
-        "-drive", f"file={image_path},format=qcow2,if=virtio",
-        "-cdrom", str(iso), "-boot", "d",
-        "-netdev", "user,id=net0", "-device", "virtio-net-pci,netdev=net0",
+        *qemu_system_base("new"),
+        "-drive", qcow2_drive(image_path),
+        "-cdrom", str(iso),
         "-qmp-pretty", f"unix:{monitor_path},server,nowait",
     ]
 
-    if IS_GOOD_OS:
-        cmd += ["--enable-kvm", "-cpu", "host", "--display", "gtk"]
-    else:
-        cmd += ["--display", "cocoa"]
-
     logs.write_event(image_name, "create", {})
     run_command(cmd)
 
-def spinner(stop_flag: threading.Event):
-    for c in itertools.cycle("|/-\\"):
-        if stop_flag.is_set():
-            break
-        print(f"\rWaiting for VM to boot... {c}", end="", flush=True)
-        time.sleep(0.1)
-    print("\rBoot wait finished.          ")
-
-def wait_with_spinner(stop_flag: threading.Event, seconds: int):
-    thread = threading.Thread(target=spinner, args=(stop_flag,))
-    thread.daemon = True
-    thread.start()
-    time.sleep(seconds)
-    stop_flag.set()
-    thread.join()
+@functools.cache
+def _ssh_key_path() -> str | None:
+    key_path = dotfiles.get_ssh_config().get("key_path")
+    return str(Path(key_path).expanduser()) if key_path else None
 
 def ssh_command(port):
-    key_path = Path(dotfiles.get_ssh_config().get("key_path"))
-    key_path = str(key_path.expanduser())
+    key_path = _ssh_key_path()
     ssh_cmd = ["ssh", "-p", str(port),
                 # IdentityOnly: prevent the agent from offering
                 # other identities than specified by the `key_path` here
@@ -233,7 +301,7 @@ def ssh_command(port):
                 "-oUserKnownHostsFile=/dev/null",
                 # Ignore our `.ssh` configuration file
                 "-F", "/dev/null",
-                "-i", str(key_path), "j@localhost"
+                "-i", key_path, "j@localhost"
                 ]
     return ssh_cmd
 
@@ -265,61 +333,87 @@ def run(
     mount: Annotated[Optional[Path], typer.Option(help="Host directory to mount via 9p")] = None,
     graphical: Annotated[bool, typer.Option(help="Enable graphical display")] = False,
     post: Annotated[Optional[Path], typer.Option(help="Script to run after VM boots")] = None,
+    strict: StrictOption = False,
 ):
     """Launch a VM from an existing image."""
-    image_path = dotfiles.get_image(image)
+    paths = dotfiles.get_image_paths(image)
+    image_path = paths.image
     meta = dotfiles.get_metadata(image_path)
     if meta.get("dependents"):
         typer.echo(f"Image '{image_path.name}' has dependent forks. Running it directly may corrupt data.", err=True)
         raise typer.Exit(code=1)
 
-    monitor_path = dotfiles.get_monitor(image)
-    validate_qcow2_format(image_path)
-    ssh_port = dotfiles.get_next_ssh_port()
-
-    cmd = [
-        dotfiles.get_binary("qemu_system"), "-m", "24G", "-smp", "4",
-        "-drive", f"file={image_path},format=qcow2,if=virtio", "-boot", "c",
-        "-netdev", f"user,id=net0,hostfwd=tcp::{ssh_port}-:22",
-        "-device", "virtio-net-pci,netdev=net0",
-        "-device", "virtio-serial", "-device", "virtio-balloon",
-        "-device", "qemu-xhci,id=xhci", # add usb support
-        "-qmp-pretty", f"unix:{monitor_path},server,nowait",
-        "-boot", "order=c",
-    ]
-    if IS_GOOD_OS:
-        cmd += [
-            "--enable-kvm", "-cpu", "host"
+    monitor_path = paths.monitor
+    validate_qcow2_format(image_path, strict)
+    with dotfiles.running_registry() as registry:
+        ssh_port = dotfiles.get_next_ssh_port(registry)
+
+        cmd = [
+            *qemu_system_base("run"),
+            "-drive", qcow2_drive(image_path),
+            "-netdev", f"user,id=net0,hostfwd=tcp::{ssh_port}-:22",
+            "-device", "virtio-net-pci,netdev=net0",
+            "-qmp-pretty", f"unix:{monitor_path},server,nowait",
         ]
 
-    if mount:
-        cmd += [
-            # security_model=mapped makes it so that
-            # the 9p mount is owned by the user inside the VM
-            # writes permissions in the extended attributes
-            # thus, modifying permissions inside the VM does not affect host
-            "-fsdev", f"local,id=fsdev0,path={mount},security_model=mapped",
-            "-device", "virtio-9p-pci,fsdev=fsdev0,mount_tag=quarantine"
-        ]
-
-    if graphical:
-        if IS_GOOD_OS:
-            cmd += ["-display", "gtk",
-                    "-device", "virtio-gpu-pci"]
+        if mount:
+            cmd += [
+                # security_model=mapped makes it so that
+                # the 9p mount is owned by the user inside the VM
+                # writes permissions in the extended attributes
+                # thus, modifying permissions inside the VM does not affect host
+                "-fsdev", f"local,id=fsdev0,path={mount},security_model=mapped",
+                "-device", "virtio-9p-pci,fsdev=fsdev0,mount_tag=quarantine"
+            ]
+
+        if graphical:
+            if IS_GOOD_OS:
+                cmd += ["-display", "gtk",
+                        "-device", "virtio-gpu-pci"]
+            else:
+                cmd += ["--display", "cocoa"]
         else:
-            cmd += ["--display", "cocoa"]
-    else:
-        cmd += ["--display", "none"]
+            cmd += ["--display", "none"]
 
-    pid = run_command(cmd)
-    dotfiles.set_running_vm(image, pid, ssh_port)
+        pid = run_command(cmd)
+        dotfiles.set_running_vm(image, pid, ssh_port, registry)
 
     logs.write_event(image, "run", {"pid": pid})
 
     if post:
         typer.echo(f"Waiting for VM to boot to run post script: {post}")
-        stop_flag = threading.Event()
-        wait_with_spinner(stop_flag, 3)
+        # a pidfd turns readable when QEMU exits, so the spinner
+        # ticks double as an exit watch instead of blind sleeps
+        try:
+            vm_exit = os.pidfd_open(pid)
+        except (AttributeError, OSError):
+            vm_exit = None
+        frames = "|/-\\"
+        deadline = time.monotonic() + 3
+        i = 0
+        exited = False
+        while not exited and time.monotonic() < deadline:
+            sys.stdout.write(f"\rWaiting for VM to boot... {frames[i & 3]}")
+            sys.stdout.flush()
+            if vm_exit is not None:
+                exited = bool(select.select([vm_exit], [], [], 0.1)[0])
+            else:
+                time.sleep(0.1)
+                # still our child, so waitpid sees it exit
+                exited = os.waitpid(pid, os.WNOHANG)[0] != 0
+            i += 1
+        if vm_exit is not None:
+            os.close(vm_exit)
+        if exited:
+            if vm_exit is not None:
+                # the pidfd only reported the exit, reap the zombie so the sweep sees it gone
+                os.waitpid(pid, 0)
+            # free the registry entry and its ssh port now rather than on some later command
+            dotfiles.clean_stale_vms()
+            print()
+            typer.echo(f"VM '{image}' exited while booting, not running post script.", err=True)
+            raise typer.Exit(code=1)
+        print("\rBoot wait finished.          ")
         post_path = Path(post).expanduser()
         if not post_path.exists() or not os.access(post_path, os.X_OK):
             typer.echo(f"Invalid post-run script: {post_path}", err=True)
@@ -333,6 +427,7 @@ def run(
 def kill(vms: Annotated[List[str], typer.Argument(help="VMs to stop", autocompletion=running_vm_names)]):
     """Gracefully shut down one or more running VMs."""
     running = dotfiles.get_running_vms()
+    monitors = []
     for vm in vms:
         if vm not in running:
             typer.echo(f"No running VM registered under name '{vm}'", err=True)
@@ -342,8 +437,12 @@ def kill(vms: Annotated[List[str], typer.Argument(help="VMs to stop", autocomple
         if not monitor_path.exists():
             typer.echo(f"Monitor socket not found for VM '{vm}'", err=True)
             raise typer.Exit(code=1)
+        monitors.append(monitor_path)
 
-        qmp.send_shutdown(monitor_path)
+    # each shutdown mostly waits on its own monitor, so talk to all of them at once
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=len(monitors)) as ex:
+        list(ex.map(qmp.send_shutdown, monitors))
 
     # There was some logic to remove the monitor manually here
     # BUt qemu appears to remove it automatically on shutdown.
@@ -366,24 +465,36 @@ def version():
 @list_app.command("images")
 def list_cmd_images():
     """List all managed VM images with metadata."""
-    out = []
-    for img in sorted(dotfiles.get_images()):
-        meta = dotfiles.get_metadata(img)
-        # include name + all metadata keys
-        entry = {"name": img.name, **meta}
-        out.append(entry)
+    names, with_meta = dotfiles.scan_images()
+    # the scan already told us which images have a sidecar, only read those;
+    # the reads are independent and I/O bound, so overlap them
+    to_read = [name for name in names if name in with_meta]
+    if len(to_read) <= 8:
+        # a handful of small reads finish before a pool would start its threads
+        metas = {name: dotfiles.get_metadata(dotfiles.get_image(name)) for name in to_read}
+    else:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=8) as ex:
+            metas = dict(zip(to_read, ex.map(dotfiles.get_metadata, map(dotfiles.get_image, to_read))))
+    # include name + all metadata keys
+    out = [{"name": name, **metas.get(name, {})} for name in names]
     typer.echo(json.dumps(out, indent=2))
 
 
 @list_app.command("vms")
 def list_cmd_vms():
     """List running VMs with resource usage."""
+    dotfiles.clean_stale_vms()
     running = dotfiles.get_running_vms()
+    pids = [info["pid"] for info in running.values()]
+    # one shared sampling interval for all VMs
+    cpus = ps.cpu_percent_batch(pids)
+    mems = ps.rss_mb_batch(pids)
     out = []
     for name, info in running.items():
         pid = info["pid"]
-        mem = ps.rss_mb(pid)
-        cpu = ps.cpu_percent(pid)
+        mem = mems[pid]
+        cpu = cpus[pid]
 
         out.append({
             "name":       name,
@@ -397,7 +508,8 @@ def list_cmd_vms():
 @app.command()
 def rm(image: Annotated[str, Argument(help="Image to remove", autocompletion=complete_image_names)]):
     """Remove a VM image and its associated files."""
-    image_path = dotfiles.get_image(image)
+    paths = dotfiles.get_image_paths(image)
+    image_path = paths.image
 
     if not image_path.exists():
         typer.echo(f"Image '{image}' not found.", err=True)
@@ -414,50 +526,23 @@ def rm(image: Annotated[str, Argument(help="Image to remove", autocompletion=com
         raise typer.Exit(code=1)
 
     if dotfiles.is_locked(image):
-        typer.echo(f"Image '{image}' appears to be locked. Inspect the lockfile at {dotfiles.LOCKS_DIR}", err=True)
+        typer.echo(f"Image '{image}' is locked by another qeman process.", err=True)
         raise typer.Exit(code=1)
 
-    # Remove image and associated files
+    # Remove image and associated files,
+    # just unlink and let missing ones slide instead of probing first
     image_path.unlink()
-    meta_path = dotfiles.get_metadata(image_path)
-    if meta_path.exists():
-        meta_path.unlink()
-
-    monitor_path = dotfiles.get_monitor(image)
-    if monitor_path.exists():
-        monitor_path.unlink()
-
-    log_path = dotfiles.get_log_path(image)
-    if log_path.exists():
-        log_path.unlink()
+    paths.meta.unlink(missing_ok=True)
+    paths.monitor.unlink(missing_ok=True)
+    paths.log.unlink(missing_ok=True)
+    # flock never removes its lockfile, the image going away is our cue
+    paths.lock.unlink(missing_ok=True)
 
 
 
 @app.command()
 def code(vm: Annotated[str, Argument(help="VM to connect to", autocompletion=running_vm_names)]):
     """Open VS Code tunnel to a running VM."""
-
-
-    def _first_url_in(line: str) -> str | None:
-        for tok in line.split():
-            if tok.startswith(("http://", "https://")):
-                return tok
-        return None
-
-    def _is_allowed(url: str) -> bool:
-        ALLOWED_HOSTS = {"github.com", "vscode.dev"}
-        try:
-            u = urllib.parse.urlparse(url)
-            return u.scheme == "https" and u.hostname in ALLOWED_HOSTS
-        except Exception:
-            return False
-
-    def _maybe_device_code(line: str) -> str | None:
-        for tok in line.split():
-            if len(tok) == 9 and tok[4] == "-" and tok.replace("-", "").isalnum() and tok.isupper():
-                return tok
-        return None
-
     running = dotfiles.get_running_vms()
     info = running.get(vm)
     if not info:
@@ -475,62 +560,64 @@ def code(vm: Annotated[str, Argument(help="VM to connect to", autocompletion=run
         read_cmd,
         stdout=subprocess.PIPE,
         stderr=subprocess.STDOUT,
-        text=True,
-        bufsize=1,  # line buffered
+        bufsize=0,
     )
-
-    done = threading.Event()
-
-    def monitor():
-        link: str | None = None
-        code: str | None = None
-        tunnel_exists = False
-
-        if not proc.stdout:
-            done.set()
-            return
-
-        opened = False
-        for raw in iter(proc.stdout.readline, ""):
+    fd = proc.stdout.fileno()
+    os.set_blocking(fd, False)
+
+    # watch the output right here until the link shows up
+    # or the deadline passes, no monitor thread needed
+    sel = selectors.DefaultSelector()
+    sel.register(fd, selectors.EVENT_READ)
+    deadline = time.monotonic() + 5
+    code: bytes | None = None
+    link: str | None = None
+    tunnel_exists = False
+    pending = b""
+    # lines are echoed straight to the byte buffer below
+    sys.stdout.flush()
+
+    while link is None:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or not sel.select(remaining):
+            typer.echo(f"VM '{vm}' tunnel timeout.", err=True)
+            break
+        chunk = os.read(fd, 4096)
+        if not chunk:
+            break  # EOF
+        *lines, pending = (pending + chunk).split(b"\n")
+        for raw in lines:
             line = raw.strip()
-            print(line)
-            if not line or line.startswith("*"):
+            # echo the raw bytes, only a matched URL ever gets decoded
+            sys.stdout.buffer.write(line + b"\n")
+            if not line or line.startswith(b"*"):
                 continue
 
-            if line.startswith("Connected to an existing tunnel"):
+            if line.startswith(b"Connected to an existing tunnel"):
                 tunnel_exists = True
 
             # pick up code if we see one
             if code is None:
-                maybe = _maybe_device_code(line)
-                if maybe:
-                    code = maybe
+                m = _DEVICE_CODE_RE.search(line)
+                if m:
+                    code = m.group()
 
-            url = _first_url_in(line)
-            if url:
-                url = url.strip()
+            m = _URL_RE.search(line)
+            if m:
+                url = m.group().decode(errors="replace")
                 if not _is_allowed(url):
                     typer.echo(f"Refusing to open untrusted URL: {url}", err=True)
                     continue  # keep scanning; maybe a valid URL comes next
-
                 link = url
-                if not opened:
-                    if not tunnel_exists and code:
-                        typer.echo(f"Device code: {code}")
-                    time.sleep(1)  # tiny debounce, sometimes it hangs without it
-                    open_browser(link)
-                    opened = True
-                    done.set()  # let the CLI return quickly
-                    return
-
-        done.set()  # EOF
-        return
-
-    t = threading.Thread(target=monitor, daemon=True)
-    t.start()
+                break
+        sys.stdout.buffer.flush()
+    sel.close()
 
-    if not done.wait(timeout=5):
-        typer.echo(f"VM '{vm}' tunnel timeout.", err=True)
+    if link:
+        if not tunnel_exists and code:
+            typer.echo(f"Device code: {code.decode()}")
+        time.sleep(1)  # tiny debounce, sometimes it hangs without it
+        open_browser(link)
 
 
 @usb_app.command("list")
@@ -572,6 +659,7 @@ def usb_attach(
     except Exception as e:
         typer.echo(f"Warning: could not verify/add xHCI: {e}", err=True)
 
+    import uuid
     dev_id = f"usb_{uuid.uuid4().hex[:8]}"
     args: dict = {"driver": "usb-host", "id": dev_id}
     if vendor and product:
@@ -699,12 +787,10 @@ def sync(
             typer.echo(f"Remote is newer, syncing remote -> host")
 
     # Build SSH options for rsync
-    ssh_config = dotfiles.get_ssh_config()
-    key_path_str = ssh_config.get("key_path")
-    if not key_path_str:
+    key_path = _ssh_key_path()
+    if not key_path:
         typer.echo("SSH key path not configured in ~/.qeman/config.toml", err=True)
         raise typer.Exit(1)
-    key_path = Path(key_path_str).expanduser()
     ssh_opts = f"ssh -p {port} -o IdentitiesOnly=yes -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null -F /dev/null -i {key_path}"
 
     # Build rsync command
@@ -745,10 +831,5 @@ def sync(
 
     typer.echo("Sync complete.")
 
-# main.py should never by a library anyway,
-# so no worries about putting this in the top level
-# we generally does not trigger the if __name__ == "__main__"
-# block as the entrypoint is `app()`
-dotfiles.clean_stale_vms()
 if __name__ == "__main__":
     app()
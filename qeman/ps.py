@@ -1,50 +1,179 @@
 import os, time, subprocess, sys
+import functools
 from pathlib import Path
 from typing import Optional
 
 IS_LINUX = sys.platform.startswith("linux")
 IS_DARWIN = sys.platform == "darwin"
 
+# --- Liveness ---
+def is_alive(pid: int) -> bool:
+    # signal 0 only checks that the pid exists, a single kill(2)
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # exists, just owned by someone else
+        return True
+    return True
+
+def alive_pids(pids: list[int]) -> set[int]:
+    return {pid for pid in pids if is_alive(pid)}
+
+# --- Darwin libproc ---
+if IS_DARWIN:
+    # only macOS pays for importing ctypes
+    import ctypes
+
+    PROC_PIDTASKINFO = 4
+
+    class _ProcTaskInfo(ctypes.Structure):
+        # struct proc_taskinfo from <sys/proc_info.h>
+        _fields_ = [
+            ("pti_virtual_size", ctypes.c_uint64),
+            ("pti_resident_size", ctypes.c_uint64),
+            ("pti_total_user", ctypes.c_uint64),
+            ("pti_total_system", ctypes.c_uint64),
+            ("pti_threads_user", ctypes.c_uint64),
+            ("pti_threads_system", ctypes.c_uint64),
+            ("pti_policy", ctypes.c_int32),
+            ("pti_faults", ctypes.c_int32),
+            ("pti_pageins", ctypes.c_int32),
+            ("pti_cow_faults", ctypes.c_int32),
+            ("pti_messages_sent", ctypes.c_int32),
+            ("pti_messages_received", ctypes.c_int32),
+            ("pti_syscalls_mach", ctypes.c_int32),
+            ("pti_syscalls_unix", ctypes.c_int32),
+            ("pti_csw", ctypes.c_int32),
+            ("pti_threadnum", ctypes.c_int32),
+            ("pti_numrunning", ctypes.c_int32),
+            ("pti_priority", ctypes.c_int32),
+        ]
+
+@functools.cache
+def _libproc():
+    try:
+        lib = ctypes.CDLL("/usr/lib/libproc.dylib")
+    except OSError:
+        return None
+    lib.proc_pidinfo.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_uint64, ctypes.c_void_p, ctypes.c_int]
+    lib.proc_pidinfo.restype = ctypes.c_int
+    return lib
+
+def _darwin_rss_bytes(pid: int) -> Optional[int]:
+    # one proc_pidinfo call instead of forking /bin/ps
+    info = _ProcTaskInfo()
+    size = ctypes.sizeof(info)
+    if _libproc().proc_pidinfo(pid, PROC_PIDTASKINFO, 0, ctypes.byref(info), size) < size:
+        return None
+    return info.pti_resident_size
+
+# --- /proc readers ---
+def _read_proc(path: str, size: int) -> bytes:
+    # raw os.read, no TextIOWrapper or codec for a one-line procfs file
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return os.read(fd, size)
+    finally:
+        os.close(fd)
+
 # --- Memory (MB) ---
 def rss_mb(pid: int) -> Optional[float]:
     try:
         if IS_LINUX:
-            with open(f"/proc/{pid}/statm") as f:
-                _, rss_pages, *_ = f.read().split()
-            rss_bytes = int(rss_pages) * os.sysconf("SC_PAGE_SIZE")
+            # statm is "size resident shared ...", only the second field matters
+            buf = _read_proc(f"/proc/{pid}/statm", 64)
+            i = buf.index(b" ") + 1
+            rss_pages = int(buf[i:buf.index(b" ", i)])
+            rss_bytes = rss_pages * os.sysconf("SC_PAGE_SIZE")
             return rss_bytes / (1024**2)
         elif IS_DARWIN:
+            if _libproc() is not None:
+                rss = _darwin_rss_bytes(pid)
+                return rss / (1024**2) if rss is not None else None
             # ps rss is in KB on macOS
             out = subprocess.check_output(["/bin/ps", "-o", "rss=", "-p", str(pid)], text=True)
             kb = int(out.strip() or "0")
             return kb / 1024.0
         else:
             return None
-    except Exception:
+    except (OSError, ValueError, subprocess.SubprocessError):
         return None
 
+def rss_mb_batch(pids: list[int]) -> dict[int, Optional[float]]:
+    if IS_DARWIN and _libproc() is None:
+        # without libproc, one ps for every pid rather than one each
+        stats = stats_batch_darwin(pids)
+        return {pid: stats[pid][0] if pid in stats else None for pid in pids}
+    return {pid: rss_mb(pid) for pid in pids}
+
 # --- CPU percent ---
-def _linux_proc_times(pid: int):
-    with open(f"/proc/{pid}/stat") as f:
-        fields = f.read().split()
-        utime = int(fields[13]); stime = int(fields[14])
+def _linux_pid_ticks(pid: int) -> int:
+    buf = _read_proc(f"/proc/{pid}/stat", 1024)
+    # comm sits in parens and may contain spaces, so count fields from the last ')'
+    fields = buf[buf.rindex(b")") + 2:].split(b" ", 14)
+    # utime and stime are fields 14 and 15, i.e. 11 and 12 after comm
+    return int(fields[11]) + int(fields[12])
+
+def _linux_total_ticks() -> int:
     with open("/proc/stat") as f:
-        total = sum(int(x) for x in f.readline().split()[1:])
-    return utime + stime, total
+        return sum(int(x) for x in f.readline().split()[1:])
 
-def cpu_percent(pid: int) -> Optional[float]:
+def _linux_sample(pids: list[int]) -> tuple[dict[int, int], int]:
+    ticks = {}
+    for pid in pids:
+        try:
+            ticks[pid] = _linux_pid_ticks(pid)
+        except (OSError, ValueError, IndexError):
+            pass
+    return ticks, _linux_total_ticks()
+
+def cpu_percent_batch(pids: list[int], interval: float = 0.1) -> dict[int, Optional[float]]:
+    """CPU usage of every pid in `pids`, sampled over a single shared interval."""
+    if not pids:
+        # nothing to sample, don't sit through the interval
+        return {}
     try:
         if IS_LINUX:
-            internal = 0.1
-            t1, tot1 = _linux_proc_times(pid); time.sleep(interval); t2, tot2 = _linux_proc_times(pid)
-            if tot2 == tot1: return 0.0
+            # one /proc/stat read and one /proc/<pid>/stat per pid on each side of one sleep
+            t1, tot1 = _linux_sample(pids); time.sleep(interval); t2, tot2 = _linux_sample(pids)
             ncpu = os.cpu_count() or 1
-            return 100.0 * (t2 - t1) / (tot2 - tot1) * ncpu
+            out: dict[int, Optional[float]] = {}
+            for pid in pids:
+                if pid not in t1 or pid not in t2:
+                    out[pid] = None
+                elif tot2 == tot1:
+                    out[pid] = 0.0
+                else:
+                    out[pid] = 100.0 * (t2[pid] - t1[pid]) / (tot2 - tot1) * ncpu
+            return out
         elif IS_DARWIN:
-            # ps %cpu is already a moving average; keep it simple
-            out = subprocess.check_output(["/bin/ps", "-o", "%cpu=", "-p", str(pid)], text=True)
-            return float(out.strip() or "0.0")
-        else:
-            return None
-    except Exception:
-        return None
\ No newline at end of file
+            # ps %cpu is already a moving average, no sampling wait involved;
+            # one ps call covers every pid
+            stats = stats_batch_darwin(pids)
+            return {pid: stats[pid][1] if pid in stats else None for pid in pids}
+    except OSError:
+        pass
+    return {pid: None for pid in pids}
+
+def stats_batch_darwin(pids: list[int]) -> dict[int, tuple[float, float]]:
+    """(rss in MB, %cpu) per pid from a single ps call; pids ps can't see are left out."""
+    if not pids:
+        return {}
+    try:
+        # ps exits 1 when any pid is gone but still prints the rest
+        out = subprocess.run(
+            ["/bin/ps", "-o", "pid=,rss=,%cpu=", "-p", ",".join(map(str, pids))],
+            capture_output=True, text=True,
+        ).stdout
+    except OSError:
+        return {}
+    stats = {}
+    for line in out.splitlines():
+        try:
+            pid, rss_kb, cpu = line.split()
+            stats[int(pid)] = (int(rss_kb) / 1024.0, float(cpu))
+        except ValueError:
+            continue
+    return stats
@@ -1,42 +1,67 @@
 import socket
-import time
 import json
+import time
 import typer
 from pathlib import Path
+from typing import Iterator
 
 def _qmp_send(sock: socket.socket, obj: dict):
     sock.sendall((json.dumps(obj) + "\n").encode("utf-8"))
 
-def _qmp_recv(sock: socket.socket, timeout=2.0) -> dict:
-    sock.settimeout(timeout)
+_decoder = json.JSONDecoder()
+
+def _split_objects(data: bytes) -> tuple[list[dict], bytes]:
+    """Parse the complete top-level JSON objects in `data`, return them and the unparsed rest."""
+    try:
+        text = data.decode("utf-8")
+    except UnicodeDecodeError:
+        return [], data  # chunk ended mid-character, wait for the rest
+    objs = []
+    pos = 0
+    while True:
+        # objects may be pretty-printed over several lines and are
+        # separated by whitespace, the C decoder handles both
+        while pos < len(text) and text[pos].isspace():
+            pos += 1
+        if pos == len(text):
+            return objs, b""
+        try:
+            obj, pos = _decoder.raw_decode(text, pos)
+        except json.JSONDecodeError:
+            return objs, text[pos:].encode("utf-8")  # incomplete, wait for more
+        objs.append(obj)
+
+def _qmp_messages(sock: socket.socket, timeout=2.0) -> Iterator[dict]:
+    # one deadline for the whole exchange, a steady trickle of
+    # async events must not keep resetting a per-recv timeout
+    deadline = time.monotonic() + timeout
     data = b""
     while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise socket.timeout("timed out waiting for QMP reply")
+        sock.settimeout(remaining)
         chunk = sock.recv(4096)
         if not chunk:
-            break
-        data += chunk
-        if b"\n" in data:
-            line, _, _ = data.rpartition(b"\n")
-            try:
-                return json.loads(line.decode("utf-8"))
-            except Exception:
-                try:
-                    return json.loads(data.decode("utf-8"))
-                except Exception:
-                    pass
-    return {}
+            return
+        objs, data = _split_objects(data + chunk)
+        yield from objs
+
+def _next_reply(messages: Iterator[dict]) -> dict:
+    # skip the greeting and async events, the reply is whatever carries return or error
+    return next((m for m in messages if "return" in m or "error" in m), {})
 
 def exec(monitor_path: Path, execute: str, arguments: dict | None = None) -> dict:
     with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
         s.connect(str(monitor_path))
-        _ = _qmp_recv(s)  # banner
+        messages = _qmp_messages(s)
         _qmp_send(s, {"execute": "qmp_capabilities"})
-        _ = _qmp_recv(s)
+        _ = _next_reply(messages)
         payload = {"execute": execute}
         if arguments:
             payload["arguments"] = arguments
         _qmp_send(s, payload)
-        return _qmp_recv(s)
+        return _next_reply(messages)
 
 def hmp(monitor_path: Path, command_line: str) -> str:
     resp = exec(monitor_path, "human-monitor-command", {"command-line": command_line})
@@ -45,17 +70,24 @@ def hmp(monitor_path: Path, command_line: str) -> str:
     return resp.get("return", "")
 
 def send_shutdown(monitor_path: Path):
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
     try:
-        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
-            s.connect(str(monitor_path))
-            s.settimeout(2)
-
-            s.sendall(b'{"execute":"qmp_capabilities"}\n')
-            time.sleep(0.1)
-            _ = s.recv(4096)
-
-            s.sendall(b'{"execute":"system_powerdown"}\n')
-            time.sleep(0.1)
-    except Exception as e:
+        s.connect(str(monitor_path))
+        # QMP reads commands off the stream in order,
+        # so both can go out in a single write
+        s.sendall(b'{"execute":"qmp_capabilities"}\n{"execute":"system_powerdown"}\n')
+    except OSError as e:
+        s.close()
         typer.echo(f"QMP command failed: {e}", err=True)
-        raise typer.Exit(code=1)
\ No newline at end of file
+        raise typer.Exit(code=1)
+
+    with s:
+        # wait for both replies instead of sleeping a fixed amount;
+        # QEMU often takes the powerdown and then goes quiet or drops
+        # the socket while the guest shuts down, which is not a failure
+        try:
+            messages = _qmp_messages(s, timeout=2)
+            _ = _next_reply(messages)
+            _ = _next_reply(messages)
+        except OSError:
+            pass